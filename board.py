@@ -17,6 +17,7 @@ The game ends when a piece cannot be placed on the board.
 import sys
 from random import Random, randrange
 from enum import Enum
+from collections import namedtuple
 
 
 __author__="Rémi Pannequin"
@@ -33,14 +34,50 @@ class Board:
     """The game board.
     
     It is represented by a list of 9*9 boolean (True meaning that the cell is
-    occupied)
+    occupied). The board hash, an int whose bit i*9+j is set when the cell at
+    line i and col j is occupied, is maintained along with the cells: they
+    must only be modified through the methods of the board.
+    
+    When `checked` is True, the hash is verified against the cells each time
+    it is read (this is slow, and meant for tests).
+    
+    >>> Board.checked = True
+    >>> b = Board()
+    >>> b.place(Piece([(0,0), (0,1), (0,2)]), 0, 6)
+    True
+    >>> for j in range(6):
+    ...     v = b._set(0, j)
+    >>> b.hash() == pow(2, 9) - 1
+    True
+    >>> (s, removed) = b.reduce()
+    >>> b.copy().hash()
+    0
+    >>> b.cells[3] = True
+    >>> b.hash()
+    Traceback (most recent call last):
+    ...
+    AssertionError: board hash out of sync with its cells
+    >>> Board.checked = False
     """
+    
+    checked = False
 
     def __init__(self, data=None):
         if data:
             self.cells = data
         else:
             self.cells = [False]*81
+        self.occupancy = self._computeHash()
+        self._regions = None
+    
+    def copy(self):
+        """Return a copy of this board
+        """
+        b = Board.__new__(Board)
+        b.cells = list(self.cells)
+        b.occupancy = self.occupancy
+        b._regions = self._regions
+        return b
     
     def __str__(self):
         """Display the board state.
@@ -80,12 +117,114 @@ class Board:
         >>> b.hash() == pow(2, 81) - 1
         True
         """
+        if Board.checked and self.occupancy != self._computeHash():
+            raise AssertionError('board hash out of sync with its cells')
+        return self.occupancy
+    
+    def _setOccupancy(self, occ):
+        """Update the hash, and the free regions if they are known
+        """
+        if self._regions is not None:
+            self._regions = updateRegions(self._regions, self.occupancy, occ)
+        self.occupancy = occ
+    
+    def regions(self):
+        """Return the connected regions of free cells, as masks of the bits
+        of the hash.
+        
+        They are computed on the first call, then updated incrementally when
+        the board is modified.
+        
+        >>> b = Board(data=[True]*9 + [False]*72)
+        >>> len(b.regions())
+        1
+        >>> b.place(Piece([(0,0), (0,1), (0,2)]), 1, 0)
+        True
+        >>> b.place(Piece([(0,0), (1,0)]), 2, 3)
+        True
+        >>> b.place(Piece([(0,0), (1,0)]), 3, 0)
+        True
+        >>> b.place(Piece([(0,0), (0,1), (0,2)]), 4, 1)
+        True
+        >>> print(b)
+        +-----------------+
+        |X X X X X X X X X|
+        |X X X            |
+        |      X          |
+        |X     X          |
+        |X X X X          |
+        |                 |
+        |                 |
+        |                 |
+        |                 |
+        +-----------------+
+        >>> sorted(bin(r).count('1') for r in b.regions())
+        [5, 57]
+        >>> (s, removed) = b.reduce()
+        >>> sorted(bin(r).count('1') for r in b.regions())
+        [5, 66]
+        """
+        if self._regions is None:
+            self._regions = components(~self.occupancy & ALL)
+        elif Board.checked:
+            expected = components(~self.occupancy & ALL)
+            if sorted(self._regions) != sorted(expected):
+                raise AssertionError('board regions out of sync with its cells')
+        return self._regions
+    
+    def analyzeRegions(self, pieces):
+        """Describe the connected regions of free cells.
+        
+        :param pieces: the list of possible pieces
+        :return: a list of Region, giving for each region its mask, its number
+            of cells, its bounding box (top, left, bottom, right) and the
+            indexes in pieces of the pieces that can be placed inside
+        
+        >>> b = Board(data=[k not in (0, 1, 9, 80) for k in range(81)])
+        >>> pieces = [Piece([(0,0)]), Piece([(0,0), (0,1)]), Piece([(0,0), (1,1)])]
+        >>> for r in sorted(b.analyzeRegions(pieces)):
+        ...     print(r.size, r.bbox, r.fits)
+        3 (0, 0, 1, 1) [0, 1]
+        1 (8, 8, 8, 8) [0]
+        """
+        r = []
+        for mask in self.regions():
+            size = bin(mask).count('1')
+            rows = [k // 9 for k in range(81) if mask >> k & 1]
+            cols = [k % 9 for k in range(81) if mask >> k & 1]
+            bbox = (min(rows), min(cols), max(rows), max(cols))
+            r.append(Region(mask, size, bbox, regionFits(mask, pieces)))
+        return r
+    
+    def _computeHash(self):
+        """Compute the hash from the cells
+        """
         n = 0
         for i in range(81):
             if self.cells[i]:
                 n += pow(2, i)
         return n
     
+    def free(self):
+        """Number of free cells on the board
+        
+        >>> Board().free()
+        81
+        """
+        return 81 - bin(self.occupancy).count('1')
+    
+    def transpose(self):
+        """Return a new board, symmetric of this one wrt the main diagonal.
+        
+        Lines, columns and zones are preserved by this symmetry.
+        
+        >>> b = Board()
+        >>> v = b._set(0, 3)
+        >>> b.transpose().at(3, 0)
+        True
+        """
+        return Board(data = [self.cells[(k % 9) * 9 + k // 9] for k in range(81)])
+    
     def _lineIdx(i):
         """Index of the cells of a line.
         """
@@ -124,6 +263,7 @@ class Board:
         """
         for k in Board._lineIdx(i):
             self.cells[k] = False
+        self._setOccupancy(self.occupancy & ~GROUPS[i])
         return Board._lineIdx(i)
     
     def _zoneIdx(i):
@@ -165,6 +305,7 @@ class Board:
         """
         for k in Board._zoneIdx(i):
             self.cells[k] = False
+        self._setOccupancy(self.occupancy & ~GROUPS[18 + i])
         return Board._zoneIdx(i)
     
     def _colIdx(i):
@@ -197,6 +338,7 @@ class Board:
         """
         for k in Board._colIdx(i):
             self.cells[k] = False
+        self._setOccupancy(self.occupancy & ~GROUPS[9 + i])
         return Board._colIdx(i)
 
     def at(self, i, j):
@@ -213,6 +355,7 @@ class Board:
             return False
         if not self.cells[i * 9 + j]: 
             self.cells[i * 9 + j] = True
+            self._setOccupancy(self.occupancy | 1 << (i * 9 + j))
             return True
         else:
             return False
@@ -229,13 +372,25 @@ class Board:
         >>> b.fit(p, 0, 7)
         False
         """
-        for e in piece.elements:
-            #print(i+ e[0], j+ e[1])
-            if i + e[0] not in range(9) or j + e[1] not in range(9):
-                return False
-            if self.at(i + e[0], j + e[1]):
-                return False
-        return True
+        if i not in range(9) or j not in range(9):
+            return False
+        m = piece.masks[i*9+j]
+        return m != 0 and not self.occupancy & m
+    
+    def fitAnywhere(self, piece):
+        """test whether a piece fit somewhere on the board
+        >>> b = Board(data=[True]*81)
+        >>> b.fitAnywhere(Piece([(0,0)]))
+        False
+        >>> b = Board(data=[True]*80 + [False])
+        >>> b.fitAnywhere(Piece([(0,0)]))
+        True
+        """
+        occ = self.occupancy
+        for (i, j, m, groups) in piece.anchors:
+            if not occ & m:
+                return True
+        return False
     
     def place(self, piece, i, j):
         """Add a piece on the board at line i and col j.
@@ -263,7 +418,8 @@ class Board:
         if not self.fit(piece, i, j):
             return False
         for e in piece.elements:
-            self._set(i + e[0], j + e[1])
+            self.cells[(i + e[0]) * 9 + j + e[1]] = True
+        self._setOccupancy(self.occupancy | piece.masks[i*9+j])
         return True
            
     def reduce(self):
@@ -319,19 +475,209 @@ class Board:
             removed.update(self.clearZone(z))
         return (len(lines)+len(cols)+len(zones), removed)
     
+    def placements(self, piece):
+        """Find all the locations where a piece fits, in one pass over its
+        precomputed masks.
+        
+        :return: a list of (i, j, n_groups, hash) for each location, with the
+            number of lines, cols or zones completed, and the hash of the
+            board once they are removed
+        
+        >>> b = Board(data=[True]*8 + [False]*73)
+        >>> p = Piece([(0,0), (1,0)])
+        >>> [(i, j, n) for (i, j, n, h) in b.placements(p)][:3]
+        [(0, 8, 1), (1, 0, 0), (1, 1, 0)]
+        >>> b.placements(p)[0][3] == pow(2, 17)
+        True
+        """
+        return placementsOf(self.occupancy, piece)
+    
+
+# Masks of the cells of each line, column and zone
+GROUPS = tuple(sum(1 << k for k in idx) for idx in
+               [Board._lineIdx(i) for i in range(9)] +
+               [Board._colIdx(i) for i in range(9)] +
+               [Board._zoneIdx(i) for i in range(9)])
+
+# Masks of all the cells, and of the cells that have a left (resp. right)
+# neighbour
+ALL = pow(2, 81) - 1
+NOT_FIRST_COL = sum(1 << k for k in range(81) if k % 9 != 0)
+NOT_LAST_COL = sum(1 << k for k in range(81) if k % 9 != 8)
+
+Region = namedtuple('Region', ['mask', 'size', 'bbox', 'fits'])
+
+
+def neighbours(mask):
+    """Mask of the cells next to (at least) one of the cells of mask
+    """
+    return (((mask << 1) & NOT_FIRST_COL) | ((mask >> 1) & NOT_LAST_COL)
+            | ((mask << 9) & ALL) | (mask >> 9))
+
+
+def dilate(mask):
+    """Add to mask the neighbours of its cells
+    """
+    return mask | neighbours(mask)
+
+
+def components(free):
+    """Split a mask of cells into its connected components, by flood fill
+    
+    >>> components(1 + 2 + 4 + pow(2, 9) + pow(2, 80))
+    [519, 1208925819614629174706176]
+    """
+    r = []
+    while free:
+        region = free & -free
+        while True:
+            grown = dilate(region) & free
+            if grown == region:
+                break
+            region = grown
+        r.append(region)
+        free &= ~region
+    return r
+
+
+def updateRegions(regions, old, new):
+    """Update the free regions of a board whose hash changes from old to
+    new. Only the regions next to the modified cells are computed again.
+    """
+    changed = old ^ new
+    if not changed:
+        return regions
+    around = dilate(changed)
+    kept = []
+    redo = changed
+    for r in regions:
+        if r & around:
+            redo |= r
+        else:
+            kept.append(r)
+    return kept + components(redo & ~new & ALL)
+
+
+def transposeHash(h):
+    """Hash of the board of hash h, transposed (see `Board.transpose`)
+    
+    >>> transposeHash(pow(2, 3)) == pow(2, 27)
+    True
+    """
+    r = 0
+    while h:
+        low = h & -h
+        k = low.bit_length() - 1
+        r |= 1 << ((k % 9) * 9 + k // 9)
+        h ^= low
+    return r
+
+
+def placementsOf(h, piece):
+    """Same as `Board.placements`, for the board of hash h
+    """
+    r = []
+    for (i, j, m, groups) in piece.anchors:
+        if h & m:
+            continue
+        full = h | m
+        n = 0
+        cleared = 0
+        for g in groups:
+            if full & g == g:
+                n += 1
+                cleared |= g
+        r.append((i, j, n, full & ~cleared))
+    return r
+
+
+def regionFits(mask, pieces):
+    """Indexes in pieces of the pieces that can be placed inside a region
+    """
+    size = bin(mask).count('1')
+    r = []
+    for (n, p) in enumerate(pieces):
+        if p.size > size:
+            continue
+        for (i, j, m, groups) in p.anchors:
+            if m & mask == m:
+                r.append(n)
+                break
+    return r
+
 
 class Piece:
     """A piece is represented by the list of its elements :
     each element is a tuple of (line, column coordinate). By convention,
     elements coordidinates are always positives (i.e. located wrt the lower 
     left element)
-    """    
     
-    def __init__(self, elements):
-        self.elements = elements
-        self.w = max([e[1] for e in self.elements])+1
-        self.h = max([e[0] for e in self.elements])+1
-        
+    Pieces are immutable and interned: creating a piece with the same elements
+    returns the same instance, whose size, bounding box and placement masks
+    are computed only once. masks[i*9+j] is the set of cells (as bits of
+    `Board.hash`) covered by the piece placed at line i and col j, or 0 when
+    it would not be inside the board. anchors lists (i, j, mask, groups) for
+    the locations inside the board, groups being the masks of the lines,
+    columns and zones the piece overlaps there.
+    
+    >>> p = Piece([(0,0), (1,0)])
+    >>> p is Piece([(1,0), (0,0)])
+    True
+    >>> p.elements, p.w, p.h, p.size
+    (((0, 0), (1, 0)), 1, 2, 2)
+    >>> p.masks[0] == 1 + pow(2, 9)
+    True
+    >>> p.masks[8*9]
+    0
+    >>> p.w = 3
+    Traceback (most recent call last):
+    ...
+    AttributeError: Piece is immutable
+    """
+    
+    __slots__ = ('elements', 'w', 'h', 'size', 'masks', 'anchors')
+    _interned = dict()
+    
+    def __new__(cls, elements):
+        key = tuple(sorted(tuple(e) for e in elements))
+        p = cls._interned.get(key)
+        if p is not None:
+            return p
+        p = object.__new__(cls)
+        elements = tuple(tuple(e) for e in elements)
+        w = max([e[1] for e in elements])+1
+        h = max([e[0] for e in elements])+1
+        masks = []
+        anchors = []
+        for i in range(9):
+            for j in range(9):
+                if i + h > 9 or j + w > 9:
+                    masks.append(0)
+                    continue
+                m = 0
+                for e in elements:
+                    m |= 1 << ((i + e[0]) * 9 + j + e[1])
+                masks.append(m)
+                groups = tuple(g for g in GROUPS if g & m)
+                anchors.append((i, j, m, groups))
+        object.__setattr__(p, 'elements', elements)
+        object.__setattr__(p, 'w', w)
+        object.__setattr__(p, 'h', h)
+        object.__setattr__(p, 'size', len(elements))
+        object.__setattr__(p, 'masks', tuple(masks))
+        object.__setattr__(p, 'anchors', tuple(anchors))
+        cls._interned[key] = p
+        return p
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('Piece is immutable')
+    
+    def __delattr__(self, name):
+        raise AttributeError('Piece is immutable')
+    
+    def __reduce__(self):
+        return (Piece, (self.elements,))
+    
     def __str__(self):
         """
         
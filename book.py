@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Opening book for the first moves of a game.
+
+The first moves from an empty board lead to few distinct positions. The book
+stores, for each position reachable by following the book during the first
+pieces of a game, the best location of each piece as found by a deep
+expectimax search. Positions are stored in canonical form: a board and its
+transposition (with the transposed piece) share the same entry.
+
+The book is saved as a table of 13 bytes records: the board hash (11 bytes),
+the piece index and the location (i*9+j).
+
+With the default options, every search completes depth 3 (the slowest takes
+about 9 seconds) and the book (18 boards, 468 entries) is built in about
+half an hour on one core. Each more piece multiplies the number of boards by
+about 17, so that a third piece would take about 7 hours: the default stops
+after two pieces.
+
+Usage:
+    book.py [--pieces=<n>] [--depth=<n>] [--time=<s>] [--output=<path>]
+    book.py (-h | --help)
+
+Options:
+    -h, --help          Display help
+    --pieces=<n>        Number of pieces covered by the book [default: 2]
+    --depth=<n>         Maximum depth of the search [default: 3]
+    --time=<s>          Time limit of each search, in seconds [default: 20]
+    --output=<path>     File to save the book to [default: book.bin]
+"""
+
+from board import placementsOf, transposeHash
+from game import SHAPES, TRANSPOSED
+from expectimax import Expectimax
+
+__author__="Rémi Pannequin"
+__copyright__ = "Copyright 2020"
+__credits__ = ["Rémi Pannequin"]
+__license__ = "GPL"
+__maintainer__ = "Rémi Pannequin"
+__email__ = "remi.pannequin@gmail.com"
+__status__ = "Development"
+
+BOOK_FILE = 'book.bin'
+HASH_BYTES = 11
+
+
+class OpeningBook:
+    """Map (board hash, piece index) to the best location of the piece
+
+    >>> b = OpeningBook()
+    >>> h = pow(2, 3)
+    >>> b.add(h, 1, (2, 5))
+    >>> b.lookup(h, 1)
+    (2, 5)
+    >>> b.lookup(transposeHash(h), TRANSPOSED[1])
+    (5, 2)
+    >>> b.lookup(h, 2) is None
+    True
+    >>> OpeningBook.fromBytes(b.toBytes()).entries == b.entries
+    True
+    """
+
+    def __init__(self):
+        self.entries = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _key(h, num):
+        """Canonical key of a position, and whether it is transposed
+        """
+        t = transposeHash(h)
+        if t < h:
+            return ((t, TRANSPOSED[num]), True)
+        return ((h, num), False)
+
+    def add(self, h, num, loc):
+        """Store the best location (i, j) of piece num on the board of hash h
+        """
+        (key, transposed) = OpeningBook._key(h, num)
+        self.entries[key] = (loc[1], loc[0]) if transposed else tuple(loc)
+
+    def lookup(self, h, num):
+        """Return the best location (i, j) of piece num on the board of hash
+        h, or None if this position is not in the book
+        """
+        (key, transposed) = OpeningBook._key(h, num)
+        loc = self.entries.get(key)
+        if loc is None or not transposed:
+            return loc
+        # the transposed piece at (i, j) covers the cells of the piece at (j, i)
+        return (loc[1], loc[0])
+
+    def toBytes(self):
+        data = bytearray()
+        for ((h, num), (i, j)) in sorted(self.entries.items()):
+            data += h.to_bytes(HASH_BYTES, 'little')
+            data.append(num)
+            data.append(i * 9 + j)
+        return bytes(data)
+
+    def fromBytes(data):
+        book = OpeningBook()
+        size = HASH_BYTES + 2
+        for k in range(0, len(data) - size + 1, size):
+            h = int.from_bytes(data[k:k + HASH_BYTES], 'little')
+            num = data[k + HASH_BYTES]
+            loc = data[k + HASH_BYTES + 1]
+            book.entries[(h, num)] = (loc // 9, loc % 9)
+        return book
+
+    def save(self, path=BOOK_FILE):
+        with open(path, 'wb') as f:
+            f.write(self.toBytes())
+
+    def load(path=BOOK_FILE):
+        with open(path, 'rb') as f:
+            return OpeningBook.fromBytes(f.read())
+
+
+def build(n_pieces=2, max_depth=3, time_limit=20, search=None, verbose=False):
+    """Build the book for the positions reachable by following it during the
+    first n_pieces pieces of a game, from an empty board
+
+    >>> book = build(1, max_depth=1)
+    >>> len(book), book.lookup(0, 0)
+    (26, (0, 0))
+    """
+    if search is None:
+        search = Expectimax()
+    book = OpeningBook()
+    frontier = {0}
+    for k in range(n_pieces):
+        reached = set()
+        for h in sorted(frontier):
+            for num in range(len(SHAPES)):
+                if book.lookup(h, num) is not None:
+                    continue
+                values = search.evalActions(h, num, max_depth, time_limit)
+                if not values:
+                    continue
+                loc = max(values, key=values.get)
+                book.add(h, num, loc)
+                for (i, j, n_groups, h1) in placementsOf(h, SHAPES[num]):
+                    if (i, j) == loc:
+                        reached.add(min(h1, transposeHash(h1)))
+            if verbose:
+                print('piece %d: %d positions' % (k + 1, len(book)))
+        frontier = reached
+    return book
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    book = build(int(args['--pieces']), int(args['--depth']),
+                 float(args['--time']), verbose=True)
+    book.save(args['--output'])
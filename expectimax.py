@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Depth-limited expectimax search.
+
+The search alternates max nodes (a board and the piece to place: choose the
+best location) and chance nodes (a board: the next piece is drawn uniformly
+among the shapes). The value of a location is the reward of the placement
+plus the value of the resulting chance node; the value of a chance node at
+depth 0 is 0, and the value of a max node where the piece cannot be placed
+is GAME_OVER_REWARD.
+
+Chance nodes enumerate every shape exactly, identical pieces being merged.
+They are pruned with Star1 (using bounds on the values derived from
+`Game.evalScore`) and Star2 probing (a lower bound of each max node child is
+first obtained by searching only its first location, with the narrow window
+that could make the chance node fail high). Max and chance nodes are kept in
+transposition tables, with the kind of bound of their value. Chance nodes of
+depth 1 are evaluated directly from the best reward of each shape, only
+looking at the groups that have few enough free cells to be completed.
+Searches run by iterative deepening under a time limit, the best location of
+each max node found by an iteration being tried first by the next one.
+
+The search works directly on board hashes, without creating boards.
+
+"""
+
+import time
+
+from board import GROUPS, placementsOf
+from game import Game, SHAPES, GAME_OVER_REWARD
+
+__author__="Rémi Pannequin"
+__copyright__ = "Copyright 2020"
+__credits__ = ["Rémi Pannequin"]
+__license__ = "GPL"
+__maintainer__ = "Rémi Pannequin"
+__email__ = "remi.pannequin@gmail.com"
+__status__ = "Development"
+
+INF = float('inf')
+
+# The distinct pieces, with the index of the shape and their probability
+CHANCE = []
+for _num, _piece in enumerate(SHAPES):
+    for _k, (_p, _n, _w) in enumerate(CHANCE):
+        if _p is _piece:
+            CHANCE[_k] = (_p, _n, _w + 1 / len(SHAPES))
+            break
+    else:
+        CHANCE.append((_piece, _num, 1 / len(SHAPES)))
+
+# Upper bound of the reward of placing each shape: all the lines, columns and
+# zones it overlaps are completed
+MAX_REWARD = [max(Game.evalScore(p, len(groups)) for (i, j, m, groups)
+                  in p.anchors) for p in SHAPES]
+
+# Maximum number of cells a piece can fill in each group: a group with more
+# free cells cannot be completed by the next placement
+FILL_LIMIT = [max(bin(m & g).count('1') for p in SHAPES
+                  for (i, j, m, groups) in p.anchors) for g in GROUPS]
+
+
+class Timeout(Exception):
+    """Raised when the time limit of a search is exceeded
+    """
+    pass
+
+
+class Expectimax:
+    """Expectimax search with a transposition table kept between searches.
+
+    >>> s = Expectimax()
+    >>> v = s.evalActions(0, 0, max_depth=1)
+    >>> v[(0, 0)], len(v)
+    (1, 81)
+    >>> s.evalActions(pow(2, 81) - 1, 0)
+    {}
+    >>> v = s.evalActions(pow(2, 9) - 2, 0, max_depth=2)
+    >>> max(v, key=v.get), max(v.values()) > 18
+    ((0, 0), True)
+    """
+
+    def __init__(self, max_entries=1000000):
+        """Create a new search
+        :param max_entries: maximum number of entries in each table
+        """
+        self.max_entries = max_entries
+        # (hash, depth) -> (value, kind), kind being 0 for an exact value,
+        # 1 for a lower bound and -1 for an upper bound
+        self.chance_table = dict()
+        # (hash, piece index, depth) -> (value, kind), for max nodes
+        self.max_table = dict()
+        # (hash, piece index) -> best location found by the last iteration
+        self.best_moves = dict()
+        self.deadline = None
+        self.nodes = 0
+        self.depth = 0
+
+    def upper(self, depth):
+        """Upper bound of the value of a chance node of given depth
+        """
+        return depth * max(MAX_REWARD)
+
+    def evalActions(self, h, num, max_depth=3, time_limit=None):
+        """Evaluate the locations of piece num on the board of hash h.
+
+        Iterative deepening stops after max_depth, or when time_limit (in
+        seconds) is exceeded; the values of the last complete iteration are
+        returned. Only the best value is exact: the other ones may be upper
+        bounds.
+        :return: a dict mapping each location (i, j) to its value
+        """
+        self.deadline = None if time_limit is None else time.time() + time_limit
+        for table in (self.chance_table, self.max_table, self.best_moves):
+            if len(table) > self.max_entries:
+                table.clear()
+        r = dict()
+        for depth in range(1, max_depth + 1):
+            try:
+                r = self.root(h, num, depth)
+            except Timeout:
+                break
+            self.depth = depth
+        return r
+
+    def ordered(self, h, num):
+        """Locations of piece num on the board h, the best one found by the
+        previous iteration first, then by decreasing reward
+        """
+        moves = placementsOf(h, SHAPES[num])
+        moves.sort(key=lambda m: -m[2])
+        best = self.best_moves.get((h, num))
+        if best is not None:
+            for k, m in enumerate(moves):
+                if (m[0], m[1]) == best:
+                    moves.insert(0, moves.pop(k))
+                    break
+        return moves
+
+    def root(self, h, num, depth):
+        r = dict()
+        best = (None, -INF)
+        for (i, j, n_groups, h1) in self.ordered(h, num):
+            reward = Game.evalScore(SHAPES[num], n_groups)
+            v = reward + self.chance(h1, depth - 1,
+                                     best[1] - reward, INF)
+            r[(i, j)] = v
+            if v > best[1]:
+                best = ((i, j), v)
+        if best[0] is not None:
+            self.best_moves[(h, num)] = best[0]
+        return r
+
+    def maxNode(self, h, num, depth, alpha, beta, moves=None):
+        """Value of placing piece num on board h, within (alpha, beta):
+        fails low (resp. high) with an upper (resp. lower) bound of the value.
+        """
+        entry = self.max_table.get((h, num, depth))
+        if entry is not None:
+            (v, kind) = entry
+            if kind == 0 or (kind > 0 and v >= beta) or (kind < 0 and v <= alpha):
+                return v
+        if moves is None:
+            moves = self.ordered(h, num)
+        if not moves:
+            return GAME_OVER_REWARD
+        piece = SHAPES[num]
+        best = (None, -INF)
+        for (i, j, n_groups, h1) in moves:
+            reward = Game.evalScore(piece, n_groups)
+            v = reward + self.chance(h1, depth - 1, max(alpha, best[1]) - reward,
+                                     beta - reward)
+            if v > best[1]:
+                best = ((i, j), v)
+                if v >= beta:
+                    break
+        self.best_moves[(h, num)] = best[0]
+        v = best[1]
+        kind = 1 if v >= beta else (-1 if v <= alpha else 0)
+        self.max_table[(h, num, depth)] = (v, kind)
+        return v
+
+    def chance(self, h, depth, alpha, beta):
+        """Value of the board h before drawing the next piece, within
+        (alpha, beta): fails low (resp. high) with an upper (resp. lower)
+        bound of the value.
+        """
+        if depth <= 0:
+            return 0
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % 256 == 0 \
+                and time.time() > self.deadline:
+            raise Timeout()
+        key = (h, depth)
+        entry = self.chance_table.get(key)
+        if entry is not None:
+            (v, kind) = entry
+            if kind == 0 or (kind > 0 and v >= beta) or (kind < 0 and v <= alpha):
+                return v
+        if depth == 1:
+            return self.store(key, self.leaf(h), 0)
+        u_child = self.upper(depth - 1)
+        # Bounds of each child: any value is above GAME_OVER_REWARD, and the
+        # reward of this placement is known exactly
+        children = []
+        for (piece, num, p) in CHANCE:
+            moves = self.ordered(h, num)
+            if not moves:
+                children.append([num, p, moves, GAME_OVER_REWARD,
+                                 GAME_OVER_REWARD])
+            else:
+                best = max(Game.evalScore(piece, m[2]) for m in moves)
+                children.append([num, p, moves, GAME_OVER_REWARD,
+                                 best + u_child])
+        lower_sum = sum(c[1] * c[3] for c in children)
+        upper_sum = sum(c[1] * c[4] for c in children)
+        if lower_sum >= beta:
+            return self.store(key, lower_sum, 1)
+        if upper_sum <= alpha:
+            return self.store(key, upper_sum, -1)
+        # Star2 probing: search the first location of each child with the
+        # window that could make this node fail high; its value is a lower
+        # bound of the child
+        for c in children:
+            (num, p, moves, lo, hi) = c
+            if lo == hi:
+                continue
+            lower_sum -= p * lo
+            upper_sum -= p * hi
+            a = max((alpha - upper_sum) / p, lo)
+            b = min((beta - lower_sum) / p, hi)
+            (i, j, n_groups, h1) = moves[0]
+            reward = Game.evalScore(SHAPES[num], n_groups)
+            v = reward + self.chance(h1, depth - 1, a - reward, b - reward)
+            if v > a:
+                c[3] = lo = min(v, hi)
+            lower_sum += p * lo
+            upper_sum += p * hi
+            if lower_sum >= beta:
+                return self.store(key, lower_sum, 1)
+        # Star1: search each child with the window that could change the
+        # outcome, given the bounds of the other children
+        for c in children:
+            (num, p, moves, lo, hi) = c
+            if lo == hi:
+                continue
+            lower_sum -= p * lo
+            upper_sum -= p * hi
+            a = (alpha - upper_sum) / p
+            b = (beta - lower_sum) / p
+            v = self.maxNode(h, num, depth, max(a, lo), min(b, hi), moves)
+            lower_sum += p * v
+            upper_sum += p * v
+            c[3] = c[4] = v
+            if v <= a:
+                return self.store(key, upper_sum, -1)
+            if v >= b:
+                return self.store(key, lower_sum, 1)
+        return self.store(key, lower_sum, 0)
+
+    def leaf(self, h):
+        """Exact value of the chance node of depth 1 of board h: the mean of
+        the best reward of each shape
+        """
+        # the groups that a placement can complete, with their free cells
+        free = ~h
+        near = [(g, g & free) for (g, n) in zip(GROUPS, FILL_LIMIT)
+                if bin(g & free).count('1') <= n]
+        v = 0
+        for (piece, num, p) in CHANCE:
+            best = -1
+            for (i, j, m, groups) in piece.anchors:
+                if h & m:
+                    continue
+                n = 0
+                for (g, f) in near:
+                    if f & m == f and g & m:
+                        n += 1
+                if n > best:
+                    best = n
+                    if n == len(near):
+                        break
+            if best < 0:
+                v += p * GAME_OVER_REWARD
+            else:
+                v += p * Game.evalScore(piece, best)
+        return v
+
+    def store(self, key, v, kind):
+        self.chance_table[key] = (v, kind)
+        return v
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -14,6 +14,10 @@ disapears.
 
 The game ends when a piece cannot be placed on the board.
 
+In hand mode, three pieces are dealt at once and can be placed in any order;
+the next three are dealt when all of them have been placed. The game ends when
+none of the remaining pieces can be placed.
+
 Scoring:
 * each time a piece is placed on the board, the score is incremented by the
   number of elements in the piece
@@ -23,7 +27,8 @@ Scoring:
 """
 
 from random import Random
-from board import Board, Piece
+from collections import OrderedDict
+from board import Board, Piece, transposeHash, placementsOf
 
 PIECES = [
     [(0,0)],
@@ -54,6 +59,33 @@ PIECES = [
     [(0,1), (1,1), (2,1), (1,0)],
     ]
 
+# Number of pieces dealt at once in hand mode
+HAND_SIZE = 3
+
+# Value of a game that ends, for the searches and the rollouts
+GAME_OVER_REWARD = -10
+
+# The interned piece of each shape index
+SHAPES = tuple(Piece(elements) for elements in PIECES)
+
+# Index of the shape symmetric of each shape wrt the main diagonal. The set of
+# pieces is closed under this symmetry only (not under rotations).
+TRANSPOSED = tuple(SHAPES.index(Piece([(c, r) for (r, c) in elements]))
+                   for elements in PIECES)
+
+
+def canonicalHash(board):
+    """Hash of a board, identical for boards that are symmetric wrt the main
+    diagonal (that have the same future given the set of pieces).
+    
+    >>> b = Board()
+    >>> v = b._set(0, 3)
+    >>> canonicalHash(b) == canonicalHash(b.transpose())
+    True
+    """
+    h = board.hash()
+    return min(h, transposeHash(h))
+
 
 class PiecesGenerator:
     def __init__(self, seed=None):
@@ -64,22 +96,98 @@ class PiecesGenerator:
     def next(self):
         """return the next piece
         """
-        num = self.rng.randint(0, len(PIECES) - 1)
-        return (Piece(PIECES[num]), num)
+        num = self.rng.randint(0, len(SHAPES) - 1)
+        return (SHAPES[num], num)
+    
+    def deal(self, n=HAND_SIZE):
+        """return a list of n pieces
+        """
+        return [self.next() for k in range(n)]
         
         
+class TransitionCache:
+    """Bounded LRU cache of the transitions (board, piece, anchor).
+    
+    Each entry stores the board after the piece has been placed and the board
+    reduced (that must not be modified: copy it), the number of removed groups
+    and the set of removed cells. The cache can be shared by several games
+    (e.g. all the rollouts of a search); `hits` and `misses` count lookups to
+    help tuning `max_size`.
+    
+    >>> cache = TransitionCache(max_size=2)
+    >>> b = Board()
+    >>> (after, n_groups, removed) = cache.transition(b, SHAPES[5], 5, 0, 0)
+    >>> after.cells[:4], n_groups, removed
+    ([True, True, True, False], 0, frozenset())
+    >>> e = cache.transition(b, SHAPES[5], 5, 0, 0)
+    >>> e = cache.transition(b, SHAPES[5], 5, 0, 1)
+    >>> e = cache.transition(b, SHAPES[5], 5, 0, 2)
+    >>> len(cache), cache.hits, cache.misses
+    (2, 1, 3)
+    """
+    
+    def __init__(self, max_size=100000):
+        """Create an empty cache
+        :param max_size: maximum number of transitions kept
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def clear(self):
+        """Remove all entries and reset the counters
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+    
+    def transition(self, board, piece, num, i, j):
+        """Return the result of placing piece (of index num) at i, j on
+        board and reducing it. The piece must fit there.
+        :return: a tuple (board, n_groups, removed)
+        """
+        key = (board.hash(), num, i, j)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        new_board = board.copy()
+        new_board.place(piece, i, j)
+        (n_groups, removed) = new_board.reduce()
+        entry = (new_board, n_groups, frozenset(removed))
+        self.entries[key] = entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+
 class Game:
-    def __init__(self, seed=None, board=None):
+    def __init__(self, seed=None, board=None, cache=None, hand=False):
         """Create a new game instance
         :param seed: the random seed to use
         :param board: initialized the board with this data
+        :param cache: a TransitionCache shared with other games, if any
+        :param hand: play in hand mode
         """
         if board:
             self.board = board
         else:
             self.board = Board()
+        self.cache = cache
         self.gen = PiecesGenerator(seed)
-        (self.next, self.next_num) = self.gen.next()
+        if hand:
+            # the remaining pieces of the hand, next being the first one
+            self.hand = self.gen.deal()
+            (self.next, self.next_num) = self.hand[0]
+        else:
+            self.hand = None
+            (self.next, self.next_num) = self.gen.next()
         self.score = 0
         self.n_rows = 9
         self.n_cols = 9
@@ -87,20 +195,79 @@ class Game:
     def play(self, i, j):
         """place next piece at location i, j on the board
         :return: the list of cells that disapeared (if any)
+        
+        Whole games keep the board hash and regions in sync with the cells,
+        with or without a transition cache:
+        
+        >>> Board.checked = True
+        >>> scores = []
+        >>> for cache in (None, TransitionCache()):
+        ...     g = Game(seed=2, cache=cache)
+        ...     while g.board.placements(g.next):
+        ...         (i, j, n_groups, h) = g.board.placements(g.next)[-1]
+        ...         removed = g.play(i, j)
+        ...         (h, regions) = (g.board.hash(), g.board.regions())
+        ...     scores.append(g.score)
+        >>> Board.checked = False
+        >>> scores[0] == scores[1] > 100
+        True
         """
-        if i not in range(9) or j not in range(9):
-             return set()
-        if not self.board.place(self.next, i, j):
+        if self.hand is not None:
+            return self.playHand(self.next_num, i, j)
+        removed = self._place(self.next, self.next_num, i, j)
+        if removed is None:
             return set()
-        (s, removed) = self.board.reduce()
-        self.score += Game.evalScore(self.next, s)
         (self.next, self.next_num) = self.gen.next()
+        return removed
+    
+    def playHand(self, num, i, j):
+        """In hand mode, place the piece of index num of the hand at location
+        i, j on the board
+        :return: the list of cells that disapeared (if any)
+        
+        >>> g = Game(seed=1, hand=True)
+        >>> (num, i, j) = g.handMoves()[0][0][0]
+        >>> len(g.hand), g.playHand(num, i, j), len(g.hand)
+        (3, set(), 2)
+        """
+        for (k, (piece, n)) in enumerate(self.hand):
+            if n == num:
+                break
+        else:
+            return set()
+        removed = self._place(piece, num, i, j)
+        if removed is None:
+            return set()
+        del self.hand[k]
+        if not self.hand:
+            self.hand = self.gen.deal()
+        (self.next, self.next_num) = self.hand[0]
+        return removed
+    
+    def _place(self, piece, num, i, j):
+        """place a piece at location i, j on the board, and update the score
+        :return: the list of cells that disapeared, or None if the piece does
+            not fit there
+        """
+        if i not in range(9) or j not in range(9):
+             return None
+        if self.cache is not None:
+            if not self.board.fit(piece, i, j):
+                return None
+            (after, s, removed) = self.cache.transition(
+                self.board, piece, num, i, j)
+            self.board = after.copy()
+        else:
+            if not self.board.place(piece, i, j):
+                return None
+            (s, removed) = self.board.reduce()
+        self.score += Game.evalScore(piece, s)
         return {(e // 9, e % 9) for e in removed}
     
     def evalScore(placed, removed_groups):
         """Compute the score increment
         """
-        v = len(placed.elements) + removed_groups * 18
+        v = placed.size + removed_groups * 18
         if removed_groups > 0:
             v += (removed_groups - 1) * 10
         return v
@@ -111,8 +278,14 @@ class Game:
         return self.board.fit(self.next, i, j)
     
     def over(self):
-        """Return true if next piece cannot be placed
+        """Return true if next piece cannot be placed (in hand mode: if none
+        of the remaining pieces can be placed)
         """
+        if self.hand is not None:
+            for (piece, num) in self.hand:
+                if self.board.fitAnywhere(piece):
+                    return False
+            return True
         for i in range (9):
             for j in range(9):
                 if self.board.fit(self.next, i, j):
@@ -124,8 +297,8 @@ class Game:
         """Display all possible pieces, mainly for testing purpose
         >>> Game.displayPossiblePieces()
         """
-        for c in PIECES:
-            print(Piece(c))
+        for p in SHAPES:
+            print(p)
             print('--------------')
     
     def actions(self):
@@ -135,14 +308,67 @@ class Game:
         actions = []
         for i in range(9):
             for j in range(9):
-                if self.board.fit(self.next, i, j):
-                    new_board = Board(data = list(self.board.cells))
+                if not self.board.fit(self.next, i, j):
+                    continue
+                if self.cache is not None:
+                    (after, n_groups, removed) = self.cache.transition(
+                        self.board, self.next, self.next_num, i, j)
+                    new_board = after.copy()
+                else:
+                    new_board = self.board.copy()
                     new_board.place(self.next, i, j)
                     (n_groups, removed) = new_board.reduce()
-                    reward = Game.evalScore(self.next, n_groups)
-                    actions.append(((i, j), reward, new_board))
+                reward = Game.evalScore(self.next, n_groups)
+                actions.append(((i, j), reward, new_board))
         return actions
 
+    
+    def handMoves(self):
+        """In hand mode, enumerate the ways to place the remaining pieces of
+        the hand, in any order.
+        
+        The placements are explored piece after piece, the states reached by
+        different orders or locations that have the same board and the same
+        remaining pieces being merged (keeping the best reward): the states
+        after each placement are shared by all the orders leading to them.
+        
+        :return: a list of (moves, reward, hash, n_left) for each distinct
+            final state, where moves is the sequence of (num, i, j) to play,
+            reward the total score increment, hash the hash of the final board
+            and n_left the number of pieces that could not be placed (the game
+            is then over)
+        
+        >>> g = Game(board=Board(data=[(k // 9 + k % 9) % 2 == 0 for k in range(81)]))
+        >>> g.hand = [(SHAPES[0], 0), (SHAPES[1], 1), (SHAPES[1], 1)]
+        >>> finals = g.handMoves()
+        >>> len(finals), {(reward, n_left) for (moves, reward, h, n_left) in finals}
+        (40, {(1, 2)})
+        >>> g.hand = [(SHAPES[0], 0), (SHAPES[0], 0), (SHAPES[0], 0)]
+        >>> len(g.handMoves()) == 40 * 39 * 38 // 6
+        True
+        """
+        start = (self.board.hash(), tuple(sorted(n for (p, n) in self.hand)))
+        layer = {start: (0, ())}
+        final = dict()
+        while layer:
+            reached = dict()
+            for ((h, rest), (reward, moves)) in layer.items():
+                stuck = True
+                for num in set(rest):
+                    k = rest.index(num)
+                    left = rest[:k] + rest[k + 1:]
+                    for (i, j, n_groups, h1) in placementsOf(h, SHAPES[num]):
+                        stuck = False
+                        r = reward + Game.evalScore(SHAPES[num], n_groups)
+                        key = (h1, left)
+                        if key not in reached or reached[key][0] < r:
+                            reached[key] = (r, moves + ((num, i, j),))
+                if stuck:
+                    final[(h, rest)] = (reward, moves)
+            layer = reached
+        return [(moves, reward, h, len(rest))
+                for ((h, rest), (reward, moves)) in final.items()]
+
 
 if __name__ == '__main__':
     g = Game()
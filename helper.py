@@ -6,12 +6,17 @@
 
 import sys
 import os
+import math
 import random
+import threading
 from enum import Enum
-from board import Board, Piece
-from game import Game, PIECES
+from board import (Board, Piece, ALL, neighbours, regionFits,
+                   updateRegions, components)
+from game import Game, TransitionCache, PIECES, SHAPES, GAME_OVER_REWARD
+from survival import SurvivalSolver, SURVIVAL_THRESHOLD, SURVIVAL_HORIZON
+from expectimax import Expectimax, MAX_REWARD
+from book import OpeningBook, BOOK_FILE
 import pickle
-import matplotlib.pyplot as plt
 import numpy
 
 __author__="Rémi Pannequin"
@@ -23,14 +28,44 @@ __email__ = "remi.pannequin@gmail.com"
 __status__ = "Development"
 
 GAMMA = 0.9
-GAME_OVER_REWARD = -10
+
+# Parameters of the rollout policies
+EPSILON = 0.1
+TEMPERATURE = 5.0
+HOLE_PENALTY = 5
+
+# A board is doomed when less than DOOM_FITS shapes can be placed on it, and a
+# free region is dead when less than DEAD_FITS shapes can be placed inside
+DOOM_FITS = 6
+DEAD_FITS = 3
+REGION_CACHE_SIZE = 100000
+
+# Number of final states of a hand refined with rollouts
+HAND_CANDIDATES = 10
 
 
 
 class Player:
-    def __init__(self):
-        self.game = Game()
-        self.Pieces = [Piece(elt) for elt in PIECES]
+    def __init__(self, cache=None, policy=None, search=None, book=None,
+                 hand=False, doom=True, prune=True):
+        """Create a new player
+        :param cache: the TransitionCache to use, if any
+        :param policy: the policy of the rollouts (see `rnd_play`)
+        :param doom: stop the rollouts on doomed boards (see `rnd_play`)
+        :param prune: skip the moves creating dead regions in the rollouts
+        :param search: an Expectimax search to use instead of the rollouts
+        :param book: an OpeningBook consulted before any search
+        :param hand: play a game in hand mode
+        """
+        self.cache = cache if cache is not None else TransitionCache()
+        self.policy = policy
+        self.doom = doom
+        self.prune = prune
+        self.search = search
+        self.book = book
+        self.game = Game(cache=self.cache, hand=hand)
+        self.Pieces = SHAPES
+        self.solver = SurvivalSolver(cache=self.cache)
     
     def loadValues(self):
         if not os.path.exists('values'):
@@ -44,11 +79,36 @@ class Player:
     
     def play(self):
         while not self.game.over():
-            actions = self.game.actions()
             print(self.game.board)
+            if self.game.hand is not None:
+                # place the whole hand, in the best order
+                r = evalHandMoves(self.game.handMoves(), cache=self.cache,
+                                  policy=self.policy, doom=self.doom,
+                                  prune=self.prune)
+                for (num, i, j) in max(r, key=r.get):
+                    self.game.playHand(num, i, j)
+                continue
+            if self.book is not None:
+                loc = self.book.lookup(self.game.board.hash(),
+                                       self.game.next_num)
+                if loc is not None and self.game.fit(*loc):
+                    self.game.play(*loc)
+                    continue
+            actions = self.game.actions()
+            if self.game.board.free() < SURVIVAL_THRESHOLD:
+                # crowded board: choose the action that keeps the game alive
+                # for the longest time (then the best reward)
+                r = evalSurvival(self.solver, actions)
+            elif self.search is not None:
+                r = evalActions(self.game, search=self.search)
+            else:
+                actions = pruneActions(self.game.board, actions)
+                r = evalActions2(actions, cache=self.cache,
+                                 policy=self.policy, doom=self.doom,
+                                 prune=self.prune)
             # choose action whose destination state has the highest value
-            found = (None, -1)
-            for (a, v) in evalActions2(actions).items():
+            found = (None, -float('inf'))
+            for (a, v) in r.items():
                 if v > found[1]:
                     found = (a, v)
             # print(found)
@@ -75,28 +135,20 @@ class Player:
                     
          
 
-def evalActions(self, actions, depth=0, n_act=10, n_next=10, max_depth=4):
-    if depth >= max_depth:
-        return {'': 0}
-    r = dict()
-    # For a subset of each actions
-    for (a, reward, new_state) in random.choices(actions, k=min(n_act, len(actions))):
-        # evaluate score for this state
-        r[a] = 0
-        # For a subset of each possible next piece
-        for next in random.choices(self.Pieces , k=n_next):
-            hlp = Helper(new_state, next)
-            new_actions = hlp.actions()
-            ev = self.evalActions(new_actions, depth+1, n_act // 2, n_next, max_depth)
-            if len(ev):
-                v = reward + sum(ev.values())/len(ev)
-            else:
-                v = reward
-            r[a] += (v/n_next) 
-    return r
+def evalActions(game, max_depth=3, time_limit=1.0, search=None):
+    """Evaluate the actions of game with a depth-limited expectimax search,
+    by iterative deepening under time_limit (in seconds)
+    :param search: the Expectimax to use, keeping its tables between calls
+    :return: a dict mapping each action (i, j) to its value
+    """
+    if search is None:
+        search = Expectimax()
+    return search.evalActions(game.board.hash(), game.next_num, max_depth,
+                              time_limit)
 
 
-def evalActions2(actions, n_rep = 100, depth = 10, n_act=20):
+def evalActions2(actions, n_rep = 100, depth = 10, n_act=20, cache=None,
+                 policy=None, doom=True, prune=True):
     r = dict()
     # For a subset of each actions
     for (a, reward, new_state) in random.choices(actions, k=min(n_act, len(actions))):
@@ -107,37 +159,343 @@ def evalActions2(actions, n_rep = 100, depth = 10, n_act=20):
         # run random play for the next moves, eval score
         #create a new game initialez with this state
         for n in range(n_rep):
-            g = Game(board=new_state)
-            score = rnd_play(g, depth)
+            g = Game(board=new_state.copy(), cache=cache)
+            score = rnd_play(g, depth, policy, doom, prune)
             r[a] += score / n_rep
             #print(r)
     return r
 
 
-def rnd_play(game, max_moves):
+def _handValue(final):
+    (moves, reward, h, n_left) = final
+    if n_left:
+        return GAME_OVER_REWARD
+    return reward - HOLE_PENALTY * holes(h)
+
+
+def evalHandMoves(finals, n_best=HAND_CANDIDATES, n_rep=20, depth=10,
+                  cache=None, policy=None, doom=True, prune=True):
+    """Evaluate the final states of a hand (see `Game.handMoves`).
+    
+    They are ranked by their reward minus a penalty for the holes left
+    (GAME_OVER_REWARD when a piece could not be placed), then the n_best ones
+    are evaluated like in evalActions2, with random play from their board.
+    :return: a dict mapping the moves of the n_best states to their value
+    """
+    r = dict()
+    for final in sorted(finals, key=_handValue, reverse=True)[:n_best]:
+        (moves, reward, h, n_left) = final
+        if n_left:
+            r[moves] = GAME_OVER_REWARD
+            continue
+        board = Board(data=[bool(h >> k & 1) for k in range(81)])
+        r[moves] = reward
+        for n in range(n_rep):
+            g = Game(board=board.copy(), cache=cache, hand=True)
+            r[moves] += rnd_play(g, depth, policy, doom, prune) / n_rep
+    return r
+
+
+def evalSurvival(solver, actions, k=SURVIVAL_HORIZON):
+    """Evaluate actions by the exact probability of placing the k next
+    pieces, the reward only breaking ties
+    """
+    # the probabilities are multiples of 1 / 26**k: scale them so that their
+    # smallest difference exceeds any reward
+    scale = (max(MAX_REWARD) + 1) * pow(len(SHAPES), k)
+    r = dict()
+    for (a, reward, new_state) in actions:
+        r[a] = solver.survival(new_state, k) * scale + reward
+    return r
+
+
+def holes(h):
+    """Number of free cells surrounded by occupied cells (or by the border)
+    on the board of hash h
+    
+    >>> holes(0)
+    0
+    >>> holes(ALL - 1 - pow(2, 40))
+    2
+    """
+    free = ~h & ALL
+    return bin(free & ~neighbours(free)).count('1')
+
+
+def shapesFitting(region):
+    """Indexes of the shapes that can be placed inside a free region (a mask
+    of cells), memoized as the same regions show up again and again
+    """
+    fits = _region_fits.get(region)
+    if fits is None:
+        if len(_region_fits) >= REGION_CACHE_SIZE:
+            _region_fits.clear()
+        fits = _region_fits[region] = regionFits(region, SHAPES)
+    return fits
+
+_region_fits = dict()
+
+# The shapes whose cells are only connected by their corners: they can
+# straddle several free regions
+DIAGONAL_SHAPES = [num for (num, p) in enumerate(SHAPES)
+                   if len(components(p.anchors[0][2])) > 1]
+
+
+def doomed(board, min_fits=DOOM_FITS):
+    """Return True if less than min_fits shapes can be placed on board: the
+    game is then very likely to end soon
+
+    >>> b = Board(data=[k not in (0, 10, 20, 30, 40) for k in range(81)])
+    >>> doomed(b, 3), doomed(b, 4)
+    (False, True)
+    """
+    fits = set()
+    for r in board.regions():
+        fits.update(shapesFitting(r))
+        if len(fits) >= min_fits:
+            return False
+    for num in DIAGONAL_SHAPES:
+        if num not in fits and board.fitAnywhere(SHAPES[num]):
+            fits.add(num)
+            if len(fits) >= min_fits:
+                return False
+    return True
+
+
+def createsDeadRegion(board, h):
+    """Return True if going from board to the board of hash h creates a free
+    region where less than DEAD_FITS shapes can be placed. The shapes of
+    DIAGONAL_SHAPES placed across several regions are ignored: a region
+    only filled that way is still considered dead.
+    """
+    before = board.regions()
+    for r in updateRegions(before, board.hash(), h):
+        if r not in before and len(shapesFitting(r)) < DEAD_FITS:
+            return True
+    return False
+
+
+def pruneActions(board, actions):
+    """Skip the actions creating dead regions, unless all of them do
+    """
+    kept = [a for a in actions if not createsDeadRegion(board, a[2].hash())]
+    return kept if kept else actions
+
+
+def uniformPolicy(game, moves):
+    """Rollout policy choosing uniformly among the locations where the next
+    piece fits
+    :param moves: the locations, as given by `Board.placements`
+    :return: the location (i, j)
+    """
+    (i, j, n_groups, h) = random.choice(moves)
+    return (i, j)
+
+
+def _greedy(moves):
+    # the reward only depends on the number of groups for a given piece
+    best = []
+    best_n = -1
+    for (i, j, n_groups, h) in moves:
+        if n_groups > best_n:
+            best = [(i, j)]
+            best_n = n_groups
+        elif n_groups == best_n:
+            best.append((i, j))
+    return random.choice(best)
+
+
+def greedyPolicy(game, moves):
+    """Rollout policy choosing a location with the best reward (as given by
+    `Game.evalScore`), ties broken at random
+    """
+    return _greedy(moves)
+
+
+def epsilonGreedyPolicy(game, moves, epsilon=EPSILON):
+    """Rollout policy choosing a location at random with probability
+    epsilon, and like `greedyPolicy` otherwise
+    """
+    if random.random() < epsilon:
+        (i, j, n_groups, h) = random.choice(moves)
+        return (i, j)
+    return _greedy(moves)
+
+
+def softmaxPolicy(game, moves, temperature=TEMPERATURE):
+    """Rollout policy choosing a location with a probability that increases
+    with its reward, minus a penalty for the holes left on the board
+    """
+    values = [Game.evalScore(game.next, n_groups) - HOLE_PENALTY * holes(h)
+              for (i, j, n_groups, h) in moves]
+    best = max(values)
+    weights = [math.exp((v - best) / temperature) for v in values]
+    (i, j, n_groups, h) = random.choices(moves, weights)[0]
+    return (i, j)
+
+
+def rnd_play(game, max_moves, policy=None, doom=False, prune=False):
     """Random play at most max moves, and return score
+    :param policy: the function choosing the moves (uniformPolicy if None)
+    :param doom: stop with GAME_OVER_REWARD as soon as the board is doomed
+    :param prune: skip the moves creating dead regions, unless all of them do
     """
+    if policy is None:
+        policy = uniformPolicy
     k = 0
     while k < max_moves:
-        
-        actions = game.actions()
-        if len(actions) == 0:
+        if game.hand is not None:
+            # in hand mode, play the first piece of the hand that fits
+            for (piece, num) in game.hand:
+                if game.board.fitAnywhere(piece):
+                    (game.next, game.next_num) = (piece, num)
+                    break
+        moves = game.board.placements(game.next)
+        if not moves or (doom and doomed(game.board)):
             return GAME_OVER_REWARD
-        (i, j) = random.choice([a[0] for a in actions])
-        game.play(i, j)
+        if prune:
+            kept = [m for m in moves
+                    if not createsDeadRegion(game.board, m[3])]
+            if kept:
+                moves = kept
+        game.play(*policy(game, moves))
         k += 1
         
     return game.score
 
 
+class Assistant:
+    """Background search giving a live best move hint for a game.
+
+    A worker thread evaluates every possible action of the last state given
+    to `update` with random rollouts (the same estimate as `evalActions2`),
+    refining the running mean of each action round after round. Crowded
+    boards are evaluated once with `evalSurvival` instead. A new call
+    to `update` cancels the current search and restarts it on the new state,
+    so that `best` and `heatmap` can be polled at any time without blocking.
+    All the rollouts share the same transition cache.
+
+    >>> a = Assistant(depth=2)
+    >>> a.best() is None
+    True
+    >>> a.heatmap()
+    {}
+    """
+
+    def __init__(self, depth=10, cache=None, policy=None, doom=True,
+                 prune=True):
+        self.depth = depth
+        self.policy = policy
+        self.doom = doom
+        self.prune = prune
+        self.cache = cache if cache is not None else TransitionCache()
+        self.solver = SurvivalSolver(cache=self.cache)
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.state = None
+        self.values = dict()
+        self.n_rollouts = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start the worker thread
+        """
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Cancel the current search and stop the worker thread
+        """
+        with self.cond:
+            self.running = False
+            self.generation += 1
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def update(self, game):
+        """Cancel the current search and restart it on the state of game
+        """
+        with self.cond:
+            self.generation += 1
+            self.state = (game.board.copy(),
+                          game.next, game.next_num)
+            self.values = dict()
+            self.n_rollouts = 0
+            self.cond.notify()
+
+    def best(self):
+        """Return the action with the best current estimate, or None
+        """
+        with self.cond:
+            if not self.values:
+                return None
+            return max(self.values, key=self.values.get)
+
+    def heatmap(self):
+        """Return a copy of the current estimate of each action (i, j)
+        """
+        with self.cond:
+            return dict(self.values)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and self.state is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                gen = self.generation
+                (board, piece, num) = self.state
+            self._search(gen, board, piece, num)
+
+    def _search(self, gen, board, piece, num):
+        game = Game(board=board.copy(), cache=self.cache)
+        (game.next, game.next_num) = (piece, num)
+        actions = game.actions()
+        if actions and board.free() < SURVIVAL_THRESHOLD:
+            # crowded board: the values are computed once
+            values = evalSurvival(self.solver, actions)
+            with self.cond:
+                if gen == self.generation:
+                    self.values = values
+            actions = []
+        if not actions:
+            # nothing to search until the next update
+            with self.cond:
+                while gen == self.generation:
+                    self.cond.wait()
+            return
+        sums = dict()
+        n = 0
+        while True:
+            n += 1
+            for (a, reward, new_state) in actions:
+                g = Game(board=new_state.copy(),
+                         cache=self.cache)
+                sums[a] = sums.get(a, 0) + rnd_play(g, self.depth,
+                                                    self.policy, self.doom,
+                                                    self.prune)
+                with self.cond:
+                    if gen != self.generation:
+                        return
+                    self.values[a] = reward + sums[a] / n
+                    self.n_rollouts += 1
 
 
-    
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
     scores = []
     #pl = Player() # just to load the data
+    book = OpeningBook.load(BOOK_FILE) if os.path.exists(BOOK_FILE) else None
     for i in range(100):
-        pl = Player()
+        pl = Player(book=book)
         sc = pl.play()
         scores.append(sc)
         #mean[i%100] = sc
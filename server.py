@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Move suggestion server
+
+Serves move suggestions to several front-ends, over TCP or a Unix socket.
+The protocol is made of JSON lines. A request is an object with:
+    id          an identifier, copied in the response
+    cells       the 81 cells of the board (0/1 or booleans), or
+    hash        the board hash (see `Board.hash`)
+    piece       the index of the next piece
+    budget      the number of rollouts per action (optional)
+    deadline    the time in seconds allowed to answer (optional)
+
+The response is either {"id": .., "move": [i, j], "value": v} ("move" is null
+when the piece cannot be placed) or {"id": .., "error": msg}. On boards with
+less than SURVIVAL_THRESHOLD free cells, the value is the one given by
+`evalSurvival` instead of the rollouts.
+
+Concurrent requests are queued and gathered in batches: requests of a batch
+on the same state share their rollouts, and the distinct states are evaluated
+in parallel by a pool of worker processes (each with its own transition
+cache). The queue is bounded, and no more than two jobs per worker are
+pending, so that connections stop being read when the server is overloaded.
+The evaluation of a state stops DEADLINE_MARGIN before the deadline of its
+requests, which get the best estimate found so far; only the requests whose
+result still arrives too late get a "deadline exceeded" error.
+
+Usage:
+    server.py [--port=<n>] [--socket=<path>] [--workers=<n>]
+    server.py --bench [--workers=<n>]
+    server.py (-h | --help)
+
+Options:
+    -h, --help          Display help
+    --port=<n>          TCP port to listen to on localhost [default: 8765]
+    --socket=<path>     Listen to this Unix socket instead
+    --workers=<n>       Number of worker processes (default: one per CPU)
+    --bench             Measure the throughput for increasing concurrency
+"""
+
+import asyncio
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from board import Board
+from game import Game, TransitionCache, SHAPES
+from helper import rnd_play, evalSurvival
+from survival import SurvivalSolver, SURVIVAL_THRESHOLD
+
+__author__="Rémi Pannequin"
+__copyright__ = "Copyright 2020"
+__credits__ = ["Rémi Pannequin"]
+__license__ = "GPL"
+__maintainer__ = "Rémi Pannequin"
+__email__ = "remi.pannequin@gmail.com"
+__status__ = "Development"
+
+DEFAULT_BUDGET = 10
+MAX_BUDGET = 1000
+ROLLOUT_DEPTH = 10
+MAX_BATCH = 64
+BATCH_WINDOW = 0.005
+QUEUE_SIZE = 256
+# Workers stop this long (in seconds) before the deadline of their requests,
+# to leave time for sending the result back
+DEADLINE_MARGIN = 0.1
+
+
+def requestId(line):
+    """The id of a request line, or None if it cannot be decoded
+
+    >>> requestId(b'{"id": 7, "piece": 99}'), requestId(b'{')
+    (7, None)
+    """
+    try:
+        req = json.loads(line)
+    except ValueError:
+        return None
+    return req.get('id') if isinstance(req, dict) else None
+
+
+def parseRequest(line):
+    """Decode a request line, return (id, board, piece, budget, deadline)
+
+    >>> (rid, b, n, budget, d) = parseRequest(b'{"id": 1, "hash": 3, "piece": 5}')
+    >>> rid, b.at(0, 1), b.at(0, 2), n, budget, d
+    (1, True, False, 5, 10, None)
+    >>> parseRequest(b'{"id": 2, "cells": [1, 0], "piece": 5}')
+    Traceback (most recent call last):
+    ...
+    ValueError: cells must contain 81 elements
+    """
+    req = json.loads(line)
+    if not isinstance(req, dict):
+        raise ValueError('request must be an object')
+    rid = req.get('id')
+    if 'cells' in req:
+        if len(req['cells']) != 81:
+            raise ValueError('cells must contain 81 elements')
+        board = Board(data=[bool(e) for e in req['cells']])
+    elif 'hash' in req:
+        h = int(req['hash'])
+        if h < 0 or h >= pow(2, 81):
+            raise ValueError('invalid board hash')
+        board = Board(data=[bool(h >> k & 1) for k in range(81)])
+    else:
+        raise ValueError('missing board cells or hash')
+    piece = int(req.get('piece', -1))
+    if piece not in range(len(SHAPES)):
+        raise ValueError('invalid piece index')
+    budget = min(max(int(req.get('budget', DEFAULT_BUDGET)), 1), MAX_BUDGET)
+    deadline = req.get('deadline')
+    if deadline is not None:
+        deadline = float(deadline)
+        if not math.isfinite(deadline):
+            raise ValueError('invalid deadline')
+    return (rid, board, piece, budget, deadline)
+
+
+def evaluateState(h, piece, budget, deadline=None):
+    """Evaluate a state with random rollouts, in a worker process.
+
+    The rollouts of all the locations are interleaved, and the clock is
+    checked after each of them, so that the evaluation stops at the deadline
+    (a `time.monotonic` time) with the best estimate found so far, among the
+    locations that have been rolled out. Crowded boards are evaluated with the
+    survival solver.
+
+    >>> evaluateState(pow(2, 81) - 1, 0, 10)
+    (None, None)
+    >>> (move, value) = evaluateState(pow(2, 9) - 2, 0, 1, time.monotonic())
+    >>> move, value
+    ((0, 0), 19)
+    >>> evaluateState(pow(2, 81) - 1 - 1 - 2 - 512, 1, 10)[0]
+    (0, 0)
+    """
+    global _cache, _solver
+    if _cache is None:
+        _cache = TransitionCache()
+        _solver = SurvivalSolver(cache=_cache)
+    g = Game(board=Board(data=[bool(h >> k & 1) for k in range(81)]),
+             cache=_cache)
+    (g.next, g.next_num) = (SHAPES[piece], piece)
+    actions = g.actions()
+    if not actions:
+        return (None, None)
+    if g.board.free() < SURVIVAL_THRESHOLD:
+        r = evalSurvival(_solver, actions)
+        a = max(r, key=r.get)
+        return (a, r[a])
+    sums = [0] * len(actions)
+    counts = [0] * len(actions)
+    expired = False
+    n = 0
+    while n < budget and not expired:
+        for (k, (a, reward, new_state)) in enumerate(actions):
+            if deadline is not None and time.monotonic() > deadline:
+                expired = True
+                break
+            rg = Game(board=new_state.copy(), cache=_cache)
+            sums[k] += rnd_play(rg, ROLLOUT_DEPTH, doom=True, prune=True)
+            counts[k] += 1
+        n += 1
+    best = (None, None)
+    for (k, (a, reward, new_state)) in enumerate(actions):
+        if counts[k] < counts[0]:
+            # not rolled out in the last round, or at all
+            continue
+        v = reward + (sums[k] / counts[k] if counts[k] else 0)
+        if best[1] is None or v > best[1]:
+            best = (a, v)
+    return best
+
+# The transition cache and survival solver of each worker process
+_cache = None
+_solver = None
+
+
+class SuggestionServer:
+    """Asyncio server batching the requests of all its connections
+    """
+
+    def __init__(self, max_batch=MAX_BATCH, batch_window=BATCH_WINDOW,
+                 queue_size=QUEUE_SIZE, workers=None):
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.queue = asyncio.Queue(queue_size)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.slots = None
+        self.server = None
+        self.batcher = None
+        self.n_batches = 0
+        self.n_requests = 0
+
+    async def start(self, host='localhost', port=8765, path=None):
+        """Start listening on a TCP port, or on a Unix socket if path is given
+        """
+        self.pool = ProcessPoolExecutor(self.workers)
+        self.slots = asyncio.Semaphore(2 * self.workers)
+        if path:
+            self.server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        self.batcher = asyncio.ensure_future(self.runBatches())
+        return self.server
+
+    async def close(self):
+        """Stop listening and cancel the batcher
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        self.pool.shutdown()
+
+    async def handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    (rid, board, piece, budget, deadline) = parseRequest(line)
+                except (ValueError, TypeError, OverflowError) as e:
+                    await self.respond(writer, lock,
+                                       {'id': requestId(line), 'error': str(e)})
+                    continue
+                loop = asyncio.get_running_loop()
+                if deadline is not None:
+                    deadline += loop.time()
+                fut = loop.create_future()
+                # Waits when the queue is full: this stops reading requests
+                # from this connection until the batcher has caught up
+                await self.queue.put((board, piece, budget, deadline, fut))
+                t = asyncio.ensure_future(
+                    self.answer(writer, lock, rid, fut, deadline))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (asyncio.CancelledError, ConnectionError):
+            # the server is closing, or the client has gone away
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, writer, lock, rid, fut, deadline):
+        try:
+            if deadline is None:
+                (move, value) = await fut
+            else:
+                timeout = deadline - asyncio.get_running_loop().time()
+                (move, value) = await asyncio.wait_for(fut, max(timeout, 0))
+            resp = {'id': rid, 'move': move and list(move), 'value': value}
+        except asyncio.TimeoutError:
+            resp = {'id': rid, 'error': 'deadline exceeded'}
+        except Exception as e:
+            resp = {'id': rid, 'error': str(e)}
+        await self.respond(writer, lock, resp)
+
+    async def respond(self, writer, lock, resp):
+        async with lock:
+            writer.write(json.dumps(resp).encode() + b'\n')
+            await writer.drain()
+
+    async def nextBatch(self):
+        """Wait for a request, then gather the ones arriving shortly after
+        """
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.batch_window
+        while len(batch) < self.max_batch:
+            try:
+                if self.queue.empty():
+                    item = await asyncio.wait_for(self.queue.get(),
+                                                  end - loop.time())
+                else:
+                    item = self.queue.get_nowait()
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+        return batch
+
+    async def runBatches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.nextBatch()
+            # Skip requests that were cancelled or whose deadline has passed
+            now = loop.time()
+            batch = [e for e in batch if not e[4].done()
+                     and (e[3] is None or e[3] > now)]
+            # Merge the requests on the same state: the largest budget and
+            # the latest deadline
+            jobs = dict()
+            for (board, piece, budget, deadline, fut) in batch:
+                key = (board.hash(), piece)
+                if key in jobs:
+                    (b, d, futs) = jobs[key]
+                    budget = max(budget, b)
+                    if deadline is not None and d is not None:
+                        deadline = max(deadline, d)
+                    else:
+                        deadline = None
+                    futs.append(fut)
+                else:
+                    futs = [fut]
+                jobs[key] = (budget, deadline, futs)
+            self.n_batches += 1
+            self.n_requests += len(batch)
+            for ((h, piece), (budget, deadline, futs)) in jobs.items():
+                # loop.time() is time.monotonic(), shared by the workers
+                if deadline is not None:
+                    deadline -= DEADLINE_MARGIN
+                await self.slots.acquire()
+                job = loop.run_in_executor(self.pool, evaluateState,
+                                           h, piece, budget, deadline)
+                job.add_done_callback(partial(self.resolve, futs))
+
+    def resolve(self, futs, job):
+        self.slots.release()
+        for fut in futs:
+            if fut.done():
+                continue
+            if job.cancelled():
+                fut.cancel()
+            elif job.exception() is not None:
+                fut.set_exception(job.exception())
+            else:
+                fut.set_result(job.result())
+
+
+class SuggestionClient:
+    """Client stub for the suggestion server, mainly for testing purpose.
+
+    Requests can be sent concurrently on the same connection; responses are
+    matched to requests by their id.
+    """
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.pending = dict()
+        self.next_id = 0
+        self.listener = None
+
+    async def connect(self, host='localhost', port=8765, path=None):
+        if path:
+            (self.reader, self.writer) = await asyncio.open_unix_connection(path)
+        else:
+            (self.reader, self.writer) = await asyncio.open_connection(host, port)
+        self.listener = asyncio.ensure_future(self.listen())
+
+    async def close(self):
+        self.writer.close()
+        await self.listener
+
+    async def listen(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            resp = json.loads(line)
+            fut = self.pending.pop(resp.get('id'), None)
+            if fut and not fut.done():
+                fut.set_result(resp)
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError('connection closed'))
+
+    async def suggest(self, board, piece, budget=None, deadline=None):
+        """Ask a move for piece (an index) on board, return the response
+        """
+        self.next_id += 1
+        req = {'id': self.next_id, 'hash': board.hash(), 'piece': piece}
+        if budget is not None:
+            req['budget'] = budget
+        if deadline is not None:
+            req['deadline'] = deadline
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = fut
+        self.writer.write(json.dumps(req).encode() + b'\n')
+        await self.writer.drain()
+        return await fut
+
+
+async def serve(port, path, workers):
+    server = SuggestionServer(workers=workers)
+    s = await server.start(port=port, path=path)
+    async with s:
+        await s.serve_forever()
+
+
+async def benchmark(workers=None, levels=(1, 2, 4, 8, 16), n_requests=32,
+                    budget=2, port=8766):
+    """Measure the throughput of the server (requests per second) when
+    n_requests requests on distinct states are sent by levels clients at a
+    time
+    """
+    import random
+    boards = []
+    rng = random.Random(0)
+    while len(boards) < n_requests:
+        g = Game(seed=len(boards))
+        for k in range(rng.randrange(20)):
+            moves = g.board.placements(g.next)
+            if not moves:
+                break
+            g.play(*rng.choice(moves)[:2])
+        boards.append((g.board, g.next_num))
+    server = SuggestionServer(workers=workers)
+    await server.start(port=port)
+    clients = []
+    for k in range(max(levels)):
+        c = SuggestionClient()
+        await c.connect(port=port)
+        clients.append(c)
+    # warm up the workers
+    await asyncio.gather(*[c.suggest(Board(), 0, 1) for c in clients])
+    for level in levels:
+        t = time.time()
+        for k in range(0, n_requests, level):
+            await asyncio.gather(*[
+                clients[n].suggest(b, num, budget) for (n, (b, num))
+                in enumerate(boards[k:k + level])])
+        t = time.time() - t
+        print('%2d concurrent requests: %6.1f requests/s'
+              % (level, n_requests / t))
+    for c in clients:
+        await c.close()
+    await server.close()
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    workers = int(args['--workers']) if args['--workers'] else None
+    if args['--bench']:
+        asyncio.run(benchmark(workers))
+    else:
+        asyncio.run(serve(int(args['--port']), args['--socket'], workers))
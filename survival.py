@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Exact survival probability for crowded boards.
+
+When the board has few free cells, the best placement is the one that keeps
+the game alive for the longest time. Random rollouts are noisy there, but the
+number of reachable positions is small enough to compute exactly the
+probability of being able to place the k next pieces, each of them drawn
+uniformly among the 26 shapes (as `PiecesGenerator` does), when playing the
+placements that maximize this probability.
+
+"""
+
+from board import Board
+from game import Game, SHAPES, canonicalHash
+
+__author__="Rémi Pannequin"
+__copyright__ = "Copyright 2020"
+__credits__ = ["Rémi Pannequin"]
+__license__ = "GPL"
+__maintainer__ = "Rémi Pannequin"
+__email__ = "remi.pannequin@gmail.com"
+__status__ = "Development"
+
+# Agents use the solver when the board has less free cells than this
+SURVIVAL_THRESHOLD = 20
+# Number of pieces the solver looks ahead
+SURVIVAL_HORIZON = 2
+
+
+class SurvivalSolver:
+    """Memoized recursion over canonical board hashes.
+
+    The survival probability of a board for k pieces is the mean, over all
+    the shapes, of the best survival probability for k - 1 pieces of the
+    boards reachable by placing that shape (0 if it does not fit).
+
+    Boards where every shape can be placed and that have more free cells than
+    max_free (typically after a line or a zone has been cleared) are cut off
+    and considered safe: this keeps the search within crowded positions.
+
+    >>> s = SurvivalSolver()
+    >>> s.survival(Board(data=[True]*81), 1)
+    0.0
+    >>> s.survival(Board(), 3)
+    1.0
+    >>> b = Board(data=[k not in (0, 1, 9) for k in range(81)])
+    >>> s.survival(b, 1) == 5 / 26
+    True
+    """
+
+    def __init__(self, max_free=SURVIVAL_THRESHOLD, cache=None,
+                 max_entries=100000):
+        """Create a new solver
+        :param max_free: boards with more free cells are considered safe
+        :param cache: a TransitionCache to use for the placements, if any
+        :param max_entries: the memo is cleared when it reaches this size
+        """
+        self.max_free = max_free
+        self.cache = cache
+        self.max_entries = max_entries
+        self.memo = dict()
+
+    def survival(self, board, k):
+        """Probability of placing the k next pieces on board
+        """
+        if k <= 0:
+            return 1.0
+        key = (canonicalHash(board), k)
+        p = self.memo.get(key)
+        if p is not None:
+            return p
+        fitting = [num for num in range(len(SHAPES))
+                   if board.fitAnywhere(SHAPES[num])]
+        if len(fitting) == len(SHAPES) and (k == 1 or board.free() > self.max_free):
+            p = 1.0
+        elif k == 1:
+            p = len(fitting) / len(SHAPES)
+        else:
+            total = 0
+            for num in fitting:
+                total += max(self.placements(board, num, k - 1).values())
+            p = total / len(SHAPES)
+        if len(self.memo) >= self.max_entries:
+            self.memo.clear()
+        self.memo[key] = p
+        return p
+
+    def placements(self, board, num, k, cutoff=True):
+        """Survival probability for the k pieces following piece num, for
+        each location (i, j) where it can be placed
+        :param cutoff: stop at the first location with a probability of 1
+        """
+        g = Game(board=board, cache=self.cache)
+        (g.next, g.next_num) = (SHAPES[num], num)
+        r = dict()
+        for (a, reward, new_board) in g.actions():
+            r[a] = self.survival(new_board, k)
+            if cutoff and r[a] == 1.0:
+                # cannot do better
+                break
+        return r
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -3,12 +3,13 @@
 """Interactive interface for the game and automatic player agent
 
 Usage:
-    fiver.py [--seed=<n>]
+    fiver.py [--seed=<n>] [--assist]
     fiver.py (-h | --help | --version)
     
 Options:
     -h, --help      Display help
     --seed=<n>      Random seed to use
+    --assist        Display the best move found by a background search
 """
 
 import sys
@@ -20,6 +21,7 @@ import pygame
 
 from game import Game
 from board import Board
+from helper import Assistant
 
 _author__="Rémi Pannequin"
 __copyright__ = "Copyright 2020"
@@ -36,15 +38,23 @@ P_COLOR = 255,255,255
 P_HOVER_COLOR = 75, 75, 75
 ZONE_COLOR = 125,125,125
 REM_COLOR = pygame.color.THECOLORS['gold']
+HINT_COLOR = pygame.color.THECOLORS['green']
+HEAT_LOW = 0, 0, 160
+HEAT_HIGH = 200, 0, 0
 REMOVE_TICK = 3
 
 class Window:
 
-    def __init__(self, seed = None, values = dict()):
+    def __init__(self, seed = None, values = dict(), assist = False):
         pygame.init()
         pygame.font.init()
         #variables
         self.seed = seed
+        if assist:
+            self.assistant = Assistant()
+            self.assistant.start()
+        else:
+            self.assistant = None
         self.reset()
         self.compute_size()
         self.removed = set()
@@ -64,6 +74,8 @@ class Window:
     def reset(self):
         self.game_over = False
         self.g = Game(seed = self.seed)
+        if self.assistant:
+            self.assistant.update(self.g)
 
 
     def pix(self, r):
@@ -154,6 +166,10 @@ class Window:
                     h = self.pix(r+1) - y - 1
                     self.win.fill(P_HOVER_COLOR, [x, y, w, h])
         
+        # Display the values and best move found by the assistant
+        if self.assistant and not self.game_over:
+            self.draw_hint()
+        
         # Evaluate current state and possible next state
         #h0 = self.g.board.hash()
         #n0 = self.g.next_num
@@ -196,18 +212,49 @@ class Window:
             self.text_centered("play again", self.replay_bt.centerx, self.replay_bt.centery)
 
 
+    def draw_hint(self):
+        heat = self.assistant.heatmap()
+        best = self.assistant.best()
+        if not heat:
+            return
+        lo = min(heat.values())
+        hi = max(heat.values())
+        for (r, c), v in heat.items():
+            t = (v - lo) / (hi - lo) if hi > lo else 1
+            color = [int(a + t * (b - a)) for a, b in zip(HEAT_LOW, HEAT_HIGH)]
+            x = self.pix(c + 0.35)
+            y = self.pix(r + 0.35)
+            w = self.pix(c + 0.65) - x
+            h = self.pix(r + 0.65) - y
+            self.win.fill(color, [x, y, w, h])
+        for e in self.g.next.elements:
+            c = best[1] + e[1]
+            r = best[0] + e[0]
+            x = self.pix(c) + 1
+            y = self.pix(r) + 1
+            w = self.pix(c+1) - x -1
+            h = self.pix(r+1) - y - 1
+            pygame.draw.rect(self.win, HINT_COLOR, [x, y, w, h], 3)
+
+
     def process_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.loop = False
+                if self.assistant:
+                    self.assistant.stop()
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 x,y = event.pos
                 #savoir dans quelle case se situe le clic
                 if x > self.pix(0) and y > self.pix(0) and x <  self.pix(9) and y < self.pix(9):
                     col = self.grid(x)
                     row = self.grid(y)
+                    score = self.g.score
                     self.removed = self.g.play(row, col)
                     self.removed_ts = REMOVE_TICK
+                    if self.assistant and self.g.score != score:
+                        # the piece was placed: search the new state
+                        self.assistant.update(self.g)
                     
                 elif self.replay_bt.collidepoint(event.pos):
                     self.reset()
@@ -234,7 +281,7 @@ if __name__=='__main__':
         s = int(args['--seed'])
     else:
         s = None
-    w = Window(seed = s)
+    w = Window(seed = s, assist = args['--assist'])
     w.loop()
     
 